@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 {
     "name": "Biometric Device Integration",
-    "version": "18.0.1.2.2",
+    "version": "18.0.1.3.0",
     "category": "Human Resources",
     "summary": "Integrating Biometric Device (Model: ZKteco uFace 202) With HR"
     "Attendance (Face + Thumb)",
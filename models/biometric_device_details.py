@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
-import datetime
+import contextlib
+import functools
 import logging
+import socket
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import psycopg2
+from psycopg2.extras import execute_values
 import pytz
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, ValidationError
@@ -8,8 +15,77 @@ from odoo.exceptions import UserError, ValidationError
 _logger = logging.getLogger(__name__)
 try:
     from zk import ZK, const
+
+    _ZK_AVAILABLE = True
 except ImportError:
+    _ZK_AVAILABLE = False
     _logger.error("Please Install pyzk library.")
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Punches this much older than the latest one downloaded are read again, the
+# device clock can move backwards when it is set or at a DST change
+_SYNC_LOOKBACK = timedelta(days=1)
+
+# Overtime punches are handled as regular punches
+_PUNCH_MAP = {
+    "4": "0",  # Overtime In -> Check In
+    "5": "1",  # Overtime Out -> Check Out
+}
+
+# A device not answering within the timeout is tried once more before
+# giving up, instead of waiting on a single long timeout
+_ZK_CONNECT_ATTEMPTS = 2
+# Receive buffer of the device sockets, large enough for a burst of punches
+# over UDP. The kernel caps it to net.core.rmem_max
+_ZK_RCVBUF = 12 * 1024 * 1024
+
+
+@functools.lru_cache(maxsize=128)
+def _tz(name):
+    """pytz timezone of the given name, shared by the devices and cron runs"""
+    return pytz.timezone(name)
+
+
+def _require_zk():
+    """Raise when the pyzk library is not installed"""
+    if not _ZK_AVAILABLE:
+        raise UserError(
+            _("Pyzk module not Found. Please install it with 'pip3 install pyzk'.")
+        )
+
+
+def _zk_disconnect(conn):
+    """Close a device connection, ignoring the errors of a dead one"""
+    try:
+        conn.disconnect()
+    except Exception as e:
+        _logger.debug("Error disconnecting from device: %s", e)
+
+
+def _zk_close_socket(zk):
+    """Close the socket of a device connection without a session, which pyzk
+    leaves open"""
+    sock = getattr(zk, "_ZK__sock", None)
+    if isinstance(sock, socket.socket):
+        sock.close()
+
+
+def _zk_tune_socket(conn):
+    """Enlarge the receive buffer of a new device connection and enable the
+    TCP keepalive. pyzk keeps its socket private, the tuning is skipped when
+    it cannot be reached"""
+    sock = getattr(conn, "_ZK__sock", None)
+    if not isinstance(sock, socket.socket):
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _ZK_RCVBUF)
+        if sock.type == socket.SOCK_STREAM:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except OSError as e:
+        _logger.debug("Unable to tune the device socket: %s", e)
 
 
 class BiometricDeviceDetails(models.Model):
@@ -34,109 +110,157 @@ class BiometricDeviceDetails(models.Model):
         default=lambda self: self.env.user.company_id.id,
         help="Current Company",
     )
+    last_sync_time = fields.Datetime(
+        string="Last Punch (Device Clock)",
+        readonly=True,
+        copy=False,
+        help="Time of the latest punch downloaded, as read on the device clock. "
+        "Older punches are skipped by the next download",
+    )
+    last_sync_display = fields.Char(
+        string="Last Synchronization",
+        compute="_compute_last_sync_display",
+        help="Time of the latest punch downloaded, as read on the device clock",
+    )
+    force_udp = fields.Boolean(
+        string="Use UDP",
+        help="Talk to the device over UDP, without the TCP handshake. Suited "
+        "for devices on the local network",
+    )
+    auto_sync_time = fields.Boolean(
+        string="Set Time on Download",
+        default=True,
+        help="Set the device time to the user's time on every download",
+    )
 
-    def device_connect(self, zk):
+    @staticmethod
+    def device_connect(zk):
         """Function for connecting the device with Odoo"""
         try:
             conn = zk.connect()
             return conn
-        except Exception:
+        except Exception as error:
+            _logger.warning("Unable to connect to the device: %s", error)
             return False
 
-    def action_test_connection(self):
-        """Checking the connection status"""
+    def _get_conn(self, timeout=5):
+        """Return a connection to the device, or False when the device cannot
+        be reached"""
+        self.ensure_one()
+        # Connecting with the device with the ip and port provided
         zk = ZK(
             self.device_ip,
             port=self.port_number,
-            timeout=30,
-            password=False,
-            ommit_ping=False,
+            timeout=timeout,
+            password=0,
+            force_udp=self.force_udp,
+            ommit_ping=True,
         )
+        for _attempt in range(_ZK_CONNECT_ATTEMPTS):
+            conn = self.device_connect(zk)
+            if conn:
+                _zk_tune_socket(conn)
+                return conn
+            # pyzk opens a new socket on every connect
+            _zk_close_socket(zk)
+        return False
+
+    @contextlib.contextmanager
+    def _zk_session(self, timeout=5):
+        """Yield a connection to the device, closed when the block ends. Many
+        devices accept a single session, it is never kept open"""
+        conn = self._get_conn(timeout=timeout)
+        if not conn:
+            raise UserError(
+                _(
+                    "Unable to connect to %(device)s, please check the parameters "
+                    "and network connections.",
+                    device=self.name,
+                )
+            )
         try:
-            if zk.connect():
-                return {
-                    "type": "ir.actions.client",
-                    "tag": "display_notification",
-                    "params": {
-                        "message": "Successfully Connected",
-                        "type": "success",
-                        "sticky": False,
-                    },
-                }
-        except Exception as error:
-            raise ValidationError(f"{error}")
+            yield conn
+        finally:
+            if conn.is_connect:
+                _zk_disconnect(conn)
+            else:
+                # The device drops the session when it restarts
+                _zk_close_socket(conn)
+
+    @api.depends("last_sync_time")
+    def _compute_last_sync_display(self):
+        """Show the device clock time as is, a Datetime would be shifted to
+        the user's timezone"""
+        for info in self:
+            info.last_sync_display = fields.Datetime.to_string(info.last_sync_time)
+
+    def _get_tz_name(self):
+        """Timezone of the current user, in which the device clock is set"""
+        return self.env.context.get("tz") or self.env.user.tz or "UTC"
+
+    def action_test_connection(self):
+        """Checking the connection status"""
+        _require_zk()
+        for info in self:
+            with info._zk_session():
+                pass
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "message": "Successfully Connected",
+                "type": "success",
+                "sticky": False,
+            },
+        }
 
     def action_set_timezone(self):
         """Function to set user's timezone to device"""
+        _require_zk()
+        user_tz = _tz(self._get_tz_name())
         for info in self:
-            machine_ip = info.device_ip
-            zk_port = info.port_number
-            try:
-                # Connecting with the device with the ip and port provided
-                zk = ZK(
-                    machine_ip,
-                    port=zk_port,
-                    timeout=15,
-                    password=0,
-                    force_udp=False,
-                    ommit_ping=False,
-                )
-            except NameError:
-                raise UserError(
-                    _(
-                        "Pyzk module not Found. Please install it"
-                        "with 'pip3 install pyzk'."
-                    )
-                )
-            conn = self.device_connect(zk)
-            if conn:
-                user_tz = self.env.context.get("tz") or self.env.user.tz or "UTC"
+            with info._zk_session() as conn:
                 user_timezone_time = pytz.utc.localize(fields.Datetime.now())
-                user_timezone_time = user_timezone_time.astimezone(
-                    pytz.timezone(user_tz)
-                )
+                if user_tz is not pytz.utc:
+                    user_timezone_time = user_timezone_time.astimezone(user_tz)
                 conn.set_time(user_timezone_time)
-                return {
-                    "type": "ir.actions.client",
-                    "tag": "display_notification",
-                    "params": {
-                        "message": "Successfully Set the Time",
-                        "type": "success",
-                        "sticky": False,
-                    },
-                }
-            else:
-                raise UserError(_("Please Check the Connection"))
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "message": "Successfully Set the Time",
+                "type": "success",
+                "sticky": False,
+            },
+        }
 
     def action_clear_attendance(self):
         """Methode to clear record from the zk.machine.attendance model and
         from the device"""
+        _require_zk()
         for info in self:
             try:
-                machine_ip = info.device_ip
-                zk_port = info.port_number
-                try:
-                    # Connecting with the device
-                    zk = ZK(
-                        machine_ip,
-                        port=zk_port,
-                        timeout=30,
-                        password=0,
-                        force_udp=False,
-                        ommit_ping=False,
-                    )
-                except NameError:
-                    raise UserError(_("Please install it with 'pip3 install pyzk'."))
-                conn = self.device_connect(zk)
-                if conn:
+                with info._zk_session(timeout=30) as conn:
                     conn.enable_device()
-                    clear_data = zk.get_attendance()
+                    clear_data = conn.get_attendance()
                     if clear_data:
                         # Clearing data in the device
                         conn.clear_attendance()
-                        # Clearing data from attendance log
-                        self._cr.execute("""delete from zk_machine_attendance""")
-                        conn.disconnect()
+                        # Clearing data from attendance log, TRUNCATE drops
+                        # the table pages instead of deleting row by row
+                        zk_attendance = self.env["zk.machine.attendance"]
+                        zk_attendance.flush_model()
+                        try:
+                            with self._cr.savepoint():
+                                self._cr.execute(
+                                    "TRUNCATE TABLE zk_machine_attendance "
+                                    "RESTART IDENTITY"
+                                )
+                        except psycopg2.Error:
+                            # TRUNCATE is refused when another table refers to
+                            # the log or without the TRUNCATE privilege
+                            self._cr.execute("DELETE FROM zk_machine_attendance")
+                        zk_attendance.invalidate_model()
                     else:
                         raise UserError(
                             _(
@@ -144,252 +268,456 @@ class BiometricDeviceDetails(models.Model):
                                 "attendance log is not empty."
                             )
                         )
-                else:
-                    raise UserError(
-                        _(
-                            "Unable to connect to Attendance Device. Please use "
-                            "Test Connection button to verify."
-                        )
-                    )
             except Exception as error:
                 raise ValidationError(f"{error}")
 
     @api.model
     def cron_download(self):
         machines = self.env["biometric.device.details"].search([])
-        for machine in machines:
-            machine.action_download_attendance()
+        if not machines:
+            return
+        _require_zk()
+        local_tz = _tz(self._get_tz_name())
+        known_ids = self._get_known_device_ids()
+        # The downloads are bound by the device network I/O, they run
+        # concurrently in threads which must not use the ORM: the fields they
+        # read are loaded beforehand, and the punches are stored afterwards
+        machines.fetch(
+            [
+                "name",
+                "device_ip",
+                "port_number",
+                "force_udp",
+                "auto_sync_time",
+                "last_sync_time",
+            ]
+        )
+        with ThreadPoolExecutor(max_workers=min(8, len(machines))) as executor:
+            futures = {
+                machine: executor.submit(machine._fetch_punches, local_tz, known_ids)
+                for machine in machines
+            }
+        for machine, future in futures.items():
+            # A failing device does not abort the other ones
+            try:
+                new_attendance, user_names, sync_time = future.result()
+            except Exception as e:
+                _logger.warning(
+                    "Unable to download attendance of device %s: %s", machine.name, e
+                )
+                continue
+            if sync_time is None:
+                _logger.info("Attendance log of device %s is empty", machine.name)
+                continue
+            # Each device is committed once stored, rolling back a failure
+            # only loses its own uncommitted work and leaves the cursor usable
+            # for the next devices
+            try:
+                processed_count = machine.with_context(
+                    from_cron=True
+                )._store_punches(new_attendance, user_names, sync_time, local_tz)
+            except Exception:
+                self.env.cr.rollback()
+                _logger.exception("Error storing attendance of device %s", machine.name)
+            else:
+                _logger.info(
+                    "%s attendance records of device %s downloaded",
+                    processed_count,
+                    machine.name,
+                )
 
     ### Action Download Attendance
     def action_download_attendance(self):
         """Function to download attendance records from the device"""
         _logger.info("++++++++++++Cron Executed++++++++++++++++++++++")
-        zk_attendance = self.env["zk.machine.attendance"]
-        hr_attendance = self.env["hr.attendance"]
+        _require_zk()
+        local_tz = _tz(self._get_tz_name())
+        known_ids = self._get_known_device_ids()
+        processed_count = 0
         for info in self:
-            machine_ip = info.device_ip
-            zk_port = info.port_number
-            try:
-                # Connecting with the device with the ip and port provided
-                zk = ZK(
-                    machine_ip,
-                    port=zk_port,
-                    timeout=15,
-                    password=0,
-                    force_udp=False,
-                    ommit_ping=False,
-                )
-            except NameError:
+            new_attendance, user_names, sync_time = info._fetch_punches(
+                local_tz, known_ids
+            )
+            if sync_time is None:
                 raise UserError(
-                    _(
-                        "Pyzk module not Found. Please install it"
-                        "with 'pip3 install pyzk'."
-                    )
+                    _("Unable to get the attendance log, please try again later.")
                 )
-            conn = self.device_connect(zk)
-            self.action_set_timezone()
-            if conn:
-                conn.disable_device()  # Device Cannot be used during this time.
-                user = conn.get_users()
+            processed_count += info._store_punches(
+                new_attendance, user_names, sync_time, local_tz
+            )
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "message": f"Successfully processed {processed_count} attendance records",
+                "type": "success",
+                "sticky": False,
+            },
+        }
+
+    def action_reset_sync_time(self):
+        """Download all the punches of the device again on the next download"""
+        self.write({"last_sync_time": False})
+
+    def _get_known_device_ids(self):
+        """Device user ids of the existing employees"""
+        employees = self.env["hr.employee"].search_read(
+            [("device_id_num", "!=", False)], ["device_id_num"]
+        )
+        return {employee["device_id_num"] for employee in employees}
+
+    def _fetch_punches(self, local_tz, known_ids):
+        """Download the new punches, user names and latest punch time"""
+        self.ensure_one()
+        # The cutoff is compared as read on the device clock, whatever the
+        # timezone of the user downloading. The punches read again are
+        # skipped by the unique index on insert
+        cutoff = None
+        if self.last_sync_time:
+            cutoff = self.last_sync_time - _SYNC_LOOKBACK
+        with self._zk_session() as conn:
+            if self.auto_sync_time:
+                # Set the device time on the connection already opened
+                conn.set_time(
+                    pytz.utc.localize(fields.Datetime.now()).astimezone(local_tz)
+                )
+            conn.disable_device()  # Device Cannot be used during this time.
+            try:
                 attendance = conn.get_attendance()
-                if attendance:
-                    processed_count = 0
-                    for each in attendance:
-                        atten_time = each.timestamp
-                        local_tz = pytz.timezone(self.env.user.partner_id.tz or "GMT")
-                        local_dt = local_tz.localize(atten_time, is_dst=None)
-                        utc_dt = local_dt.astimezone(pytz.utc)
-                        utc_dt = utc_dt.strftime("%Y-%m-%d %H:%M:%S")
-                        atten_time = datetime.datetime.strptime(
-                            utc_dt, "%Y-%m-%d %H:%M:%S"
+                new_attendance = [
+                    each
+                    for each in attendance
+                    if cutoff is None or each.timestamp >= cutoff
+                ]
+                user_names = {}
+                # The device users are only needed to create the employees
+                # missing in Odoo
+                if not {each.user_id for each in new_attendance} <= known_ids:
+                    user_names = {uid.user_id: uid.name for uid in conn.get_users()}
+            finally:
+                try:
+                    conn.enable_device()
+                except Exception as e:
+                    _logger.error("Error enabling the device: %s", e)
+        if not attendance:
+            return [], {}, None
+        return new_attendance, user_names, max(each.timestamp for each in attendance)
+
+    def _store_punches(self, new_attendance, user_names, sync_time, local_tz):
+        """Store the downloaded punches and update the employee attendances"""
+        self.ensure_one()
+        max_records_per_batch = 500
+        processed_count = 0
+        # Process the punches of each user in chronological order, so the
+        # open attendance tracked in memory is always the latest one
+        attendance = sorted(new_attendance, key=lambda a: (a.user_id, a.timestamp))
+        from_cron = self.env.context.get("from_cron")
+        for batch in self._iter_attendance_batches(attendance, max_records_per_batch):
+            if from_cron:
+                # The batch is committed on its own and its punches can be
+                # read again from the device, do not wait for the WAL to be
+                # flushed to disk when committing it
+                self.env.cr.execute("SET LOCAL synchronous_commit TO OFF")
+            processed_count += self._process_attendance_isolated(
+                batch, user_names, self, local_tz
+            )
+            if from_cron:
+                # Keep the stored batches and release their locks, the
+                # next cron run resumes from the punches not stored yet
+                self.env.cr.commit()
+        # The punches in error are not held back: the ones whose log could
+        # not be stored are read again while in the lookback window
+        self.write({"last_sync_time": sync_time})
+        if from_cron:
+            self.env.cr.commit()
+        return processed_count
+
+    def _iter_attendance_batches(self, attendance, batch_size):
+        """Yield the punches in lists of batch_size records"""
+        batch = []
+        for each in attendance:
+            batch.append(each)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _convert_to_utc(self, timestamps, local_tz):
+        """Convert naive datetimes read in local_tz to naive UTC datetimes.
+        The conversion is vectorized with pandas when it is installed"""
+        if pd is None:
+            return [
+                local_tz.localize(timestamp, is_dst=None)
+                .astimezone(pytz.utc)
+                .replace(tzinfo=None)
+                for timestamp in timestamps
+            ]
+        # Like is_dst=None, ambiguous or nonexistent local times raise
+        return list(
+            pd.DatetimeIndex(timestamps)
+            .tz_localize(local_tz, ambiguous="raise", nonexistent="raise")
+            .tz_convert("UTC")
+            .tz_localize(None)
+            .to_pydatetime()
+        )
+
+    def _process_attendance_isolated(self, batch, user_names, info, local_tz):
+        """Process the batch in a savepoint, so a failing insert does not
+        abort the records already stored. A failing batch is retried in
+        smaller batches, down to single punches, whose raw log is still
+        stored when only their attendance fails. Returns the number of
+        processed attendance records"""
+        try:
+            with self.env.cr.savepoint():
+                return self._process_attendance_batch(
+                    batch, user_names, info, local_tz
+                )
+        except Exception as e:
+            if len(batch) == 1:
+                _logger.error(
+                    "Error processing the punch of user %s at %s: %s",
+                    batch[0].user_id,
+                    batch[0].timestamp,
+                    e,
+                )
+                try:
+                    with self.env.cr.savepoint():
+                        self._process_attendance_batch(
+                            batch, user_names, info, local_tz, update_attendances=False
                         )
+                except Exception as log_error:
+                    _logger.error("Unable to store the punch log: %s", log_error)
+                return 0
+            _logger.warning(
+                "Error processing a batch of %d punches, retrying it in "
+                "smaller batches: %s",
+                len(batch),
+                e,
+            )
+        sub_batch_size = 10 if len(batch) > 10 else 1
+        return sum(
+            self._process_attendance_isolated(sub_batch, user_names, info, local_tz)
+            for sub_batch in self._iter_attendance_batches(batch, sub_batch_size)
+        )
 
-                        for uid in user:
-                            if uid.user_id == each.user_id:
-                                get_user_id = self.env["hr.employee"].search(
-                                    [("device_id_num", "=", each.user_id)]
-                                )
-                                if get_user_id:
-                                    duplicate_atten_ids = zk_attendance.search(
-                                        [
-                                            ("device_id_num", "=", each.user_id),
-                                            ("punching_time", "=", atten_time),
-                                        ]
-                                    )
-                                    if not duplicate_atten_ids:
-                                        # Get the original punch type
-                                        original_punch = str(each.punch)
-
-                                        # Map overtime punches to regular punches
-                                        if original_punch == "4":  # Overtime In
-                                            effective_punch = "0"  # Map to Check In
-                                        elif original_punch == "5":  # Overtime Out
-                                            effective_punch = "1"  # Map to Check Out
-                                        else:
-                                            effective_punch = original_punch
-
-                                        # Store the original punch in the zk_attendance table
-                                        zk_attendance.create(
-                                            {
-                                                "employee_id": get_user_id.id,
-                                                "device_id_num": each.user_id,
-                                                "attendance_type": str(each.status),
-                                                "punch_type": original_punch,
-                                                "punching_time": atten_time,
-                                                "address_id": info.address_id.id,
-                                            }
-                                        )
-
-                                        # Process based on the effective punch type
-                                        if (
-                                            effective_punch == "0"
-                                        ):  # Check In (including mapped Overtime In)
-                                            # Find if there's an open attendance record
-                                            open_attendance = hr_attendance.search(
-                                                [
-                                                    (
-                                                        "employee_id",
-                                                        "=",
-                                                        get_user_id.id,
-                                                    ),
-                                                    ("check_out", "=", False),
-                                                ],
-                                                limit=1,
-                                            )
-
-                                            if open_attendance:
-                                                # If there's an open attendance, close it first
-                                                open_attendance.write(
-                                                    {"check_out": atten_time}
-                                                )
-
-                                            # Create a new check-in
-                                            try:
-                                                hr_attendance.create(
-                                                    {
-                                                        "employee_id": get_user_id.id,
-                                                        "check_in": atten_time,
-                                                    }
-                                                )
-                                                processed_count += 1
-                                            except Exception as e:
-                                                _logger.error(
-                                                    f"Error creating attendance: {e}"
-                                                )
-
-                                        elif (
-                                            effective_punch == "1"
-                                        ):  # Check Out (including mapped Overtime Out)
-                                            # Find if there's an open attendance record
-                                            open_attendance = hr_attendance.search(
-                                                [
-                                                    (
-                                                        "employee_id",
-                                                        "=",
-                                                        get_user_id.id,
-                                                    ),
-                                                    ("check_out", "=", False),
-                                                ],
-                                                limit=1,
-                                            )
-
-                                            if open_attendance:
-                                                # If there's an open attendance, close it
-                                                open_attendance.write(
-                                                    {"check_out": atten_time}
-                                                )
-                                                processed_count += 1
-                                            else:
-                                                # No open attendance to close, create a check-in
-                                                try:
-                                                    hr_attendance.create(
-                                                        {
-                                                            "employee_id": get_user_id.id,
-                                                            "check_in": atten_time,
-                                                        }
-                                                    )
-                                                    processed_count += 1
-                                                except Exception as e:
-                                                    _logger.error(
-                                                        f"Error creating attendance: {e}"
-                                                    )
-                                else:
-                                    # Create a new employee record if not found
-                                    employee = self.env["hr.employee"].create(
-                                        {
-                                            "device_id_num": each.user_id,
-                                            "name": uid.name,
-                                        }
-                                    )
-
-                                    # Store the original punch in the database
-                                    zk_attendance.create(
-                                        {
-                                            "employee_id": employee.id,
-                                            "device_id_num": each.user_id,
-                                            "attendance_type": str(each.status),
-                                            "punch_type": str(each.punch),
-                                            "punching_time": atten_time,
-                                            "address_id": info.address_id.id,
-                                        }
-                                    )
-
-                                    # For new employees, always create a check-in
-                                    try:
-                                        hr_attendance.create(
-                                            {
-                                                "employee_id": employee.id,
-                                                "check_in": atten_time,
-                                            }
-                                        )
-                                        processed_count += 1
-                                    except Exception as e:
-                                        _logger.error(f"Error creating attendance: {e}")
-
-                    # Enable device and disconnect
-                    try:
-                        conn.enable_device()
-                        conn.disconnect()
-                    except Exception as e:
-                        _logger.error(f"Error disconnecting from device: {e}")
-
-                    return {
-                        "type": "ir.actions.client",
-                        "tag": "display_notification",
-                        "params": {
-                            "message": f"Successfully processed {processed_count} attendance records",
-                            "type": "success",
-                            "sticky": False,
-                        },
-                    }
-                else:
-                    # Enable device and disconnect
-                    try:
-                        conn.enable_device()
-                        conn.disconnect()
-                    except Exception as e:
-                        _logger.error(f"Error disconnecting from device: {e}")
-
-                    raise UserError(
-                        _("Unable to get the attendance log, please try again later.")
-                    )
+    def _process_attendance_batch(
+        self, batch, user_names, info, local_tz, update_attendances=True
+    ):
+        """Store a batch of punches from the device and update the
+        attendances of the employees. user_names maps the device user ids to
+        their names, it only needs to hold the users without an employee. The
+        punching times are read in local_tz. Only the punch log is stored
+        when update_attendances is not set. Returns the number of processed
+        attendance records"""
+        # Bulk import: no chatter messages nor tracking on the created records
+        import_context = {
+            "tracking_disable": True,
+            "mail_create_nolog": True,
+            "mail_notrack": True,
+        }
+        hr_attendance = self.env["hr.attendance"].with_context(**import_context)
+        zk_vals = []
+        attendance_events = []
+        device_ids = list(dict.fromkeys(each.user_id for each in batch))
+        # Employee ids by device user id, read in one query without
+        # building the records
+        employees = self.env["hr.employee"].search_read(
+            [("device_id_num", "in", device_ids)], ["device_id_num"]
+        )
+        emp_by_dev = {emp["device_id_num"]: emp["id"] for emp in employees}
+        # Create a new employee record for the device users not found
+        missing_ids = [dev_id for dev_id in device_ids if dev_id not in emp_by_dev]
+        unknown_ids = [dev_id for dev_id in missing_ids if dev_id not in user_names]
+        if unknown_ids:
+            _logger.warning(
+                "Skipping punches of users unknown to the device %s: %s",
+                info.name,
+                ", ".join(sorted(unknown_ids)),
+            )
+            missing_ids = [dev_id for dev_id in missing_ids if dev_id in user_names]
+        new_employees = self.env["hr.employee"].with_context(**import_context).create(
+            [
+                {
+                    "device_id_num": dev_id,
+                    "name": user_names[dev_id],
+                }
+                for dev_id in missing_ids
+            ]
+        )
+        emp_by_dev.update(zip(missing_ids, new_employees.ids))
+        new_dev_ids = set(missing_ids)
+        # Drop the punches of the skipped users before any per-punch work
+        batch = [each for each in batch if each.user_id in emp_by_dev]
+        # Device times are local, convert them to naive UTC datetimes
+        utc_times = self._convert_to_utc([each.timestamp for each in batch], local_tz)
+        punches = list(zip(batch, utc_times))
+
+        address_id = info.address_id.id
+        for each, atten_time in punches:
+            # Store the original punch in the zk_attendance table
+            zk_vals.append(
+                {
+                    "employee_id": emp_by_dev[each.user_id],
+                    "device_id_num": each.user_id,
+                    "attendance_type": str(each.status),
+                    "punch_type": str(each.punch),
+                    "punching_time": atten_time,
+                    "address_id": address_id,
+                }
+            )
+        inserted = self._insert_zk_attendance(zk_vals)
+        if not update_attendances:
+            return 0
+
+        # Only the punches actually inserted update the attendances, the ones
+        # already stored were processed by a previous download
+        for vals in zk_vals:
+            dev_id = vals["device_id_num"]
+            key = (dev_id, vals["punching_time"])
+            if key not in inserted:
+                continue
+            inserted.discard(key)
+            punch_s = vals["punch_type"]
+            if dev_id in new_dev_ids:
+                # For new employees, always create a check-in
+                new_dev_ids.discard(dev_id)
+                effective_punch = "0"
             else:
-                raise UserError(
-                    _(
-                        "Unable to connect, please check the"
-                        "parameters and network connections."
-                    )
+                effective_punch = _PUNCH_MAP.get(punch_s, punch_s)
+            if effective_punch in ("0", "1"):
+                attendance_events.append(
+                    (vals["employee_id"], effective_punch, vals["punching_time"])
+                )
+
+        # Open attendances of the batch's employees, by employee id. Records
+        # already stored are fetched once, the ones opened in this batch are
+        # kept as values so that they are all inserted with a single create
+        open_attendances = hr_attendance.search(
+            [
+                ("employee_id", "in", list({event[0] for event in attendance_events})),
+                ("check_out", "=", False),
+            ]
+        )
+        open_by_emp = {att.employee_id.id: att for att in open_attendances}
+        attendance_vals = []
+        pending_closes = {}
+        for employee_id, effective_punch, atten_time in attendance_events:
+            if effective_punch == "0":  # Check In (including mapped Overtime In)
+                self._process_check_in(
+                    employee_id,
+                    atten_time,
+                    open_by_emp,
+                    attendance_vals,
+                    pending_closes,
+                )
+            else:  # Check Out (including mapped Overtime Out)
+                self._process_check_out(
+                    employee_id,
+                    atten_time,
+                    open_by_emp,
+                    attendance_vals,
+                    pending_closes,
                 )
+        # Close the stored attendances with one write per check out time
+        ids_by_check_out = defaultdict(list)
+        for attendance_id, check_out in pending_closes.items():
+            ids_by_check_out[check_out].append(attendance_id)
+        for check_out, attendance_ids in ids_by_check_out.items():
+            hr_attendance.browse(attendance_ids).write({"check_out": check_out})
+        attendance_vals.extend(
+            vals for vals in open_by_emp.values() if isinstance(vals, dict)
+        )
+        hr_attendance.create(attendance_vals)
+        return len(attendance_events)
+
+    def _insert_zk_attendance(self, vals_list):
+        """Bulk insert the punch log, returning the inserted punch keys"""
+        if not vals_list:
+            return set()
+        zk_attendance = self.env["zk.machine.attendance"]
+        zk_attendance.flush_model()
+        now = fields.Datetime.now()
+        columns = [
+            "employee_id",
+            "device_id_num",
+            "attendance_type",
+            "punch_type",
+            "punching_time",
+            "address_id",
+            "check_in",
+            "create_uid",
+            "create_date",
+            "write_uid",
+            "write_date",
+        ]
+        rows = [
+            tuple(vals[column] or None for column in columns[:6])
+            + (now, self.env.uid, now, self.env.uid, now)
+            for vals in vals_list
+        ]
+        inserted = execute_values(
+            self.env.cr._obj,
+            f"INSERT INTO {zk_attendance._table} ({', '.join(columns)}) VALUES %s "
+            "ON CONFLICT (device_id_num, punching_time) DO NOTHING "
+            "RETURNING device_id_num, punching_time",
+            rows,
+            # The default of 100 rows would split a batch in 5 statements
+            page_size=1000,
+            fetch=True,
+        )
+        zk_attendance.invalidate_model()
+        return set(inserted)
+
+    def _process_check_in(
+        self, employee_id, atten_time, open_by_emp, attendance_vals, pending_closes
+    ):
+        """Close the open attendance of the employee, if any, and open a new
+        one at the punching time"""
+        self._close_open_attendance(
+            employee_id, atten_time, open_by_emp, attendance_vals, pending_closes
+        )
+        open_by_emp[employee_id] = {
+            "employee_id": employee_id,
+            "check_in": atten_time,
+        }
+
+    def _process_check_out(
+        self, employee_id, atten_time, open_by_emp, attendance_vals, pending_closes
+    ):
+        """Close the open attendance of the employee, or open a new one when
+        there is no attendance to close"""
+        if not self._close_open_attendance(
+            employee_id, atten_time, open_by_emp, attendance_vals, pending_closes
+        ):
+            open_by_emp[employee_id] = {
+                "employee_id": employee_id,
+                "check_in": atten_time,
+            }
+
+    def _close_open_attendance(
+        self, employee_id, atten_time, open_by_emp, attendance_vals, pending_closes
+    ):
+        """Close the attendance left open for the employee, either a stored
+        record, whose check out is queued in pending_closes, or the values of
+        one opened earlier in the batch. Returns whether an attendance was
+        closed"""
+        open_attendance = open_by_emp.pop(employee_id, None)
+        if isinstance(open_attendance, dict):
+            open_attendance["check_out"] = atten_time
+            attendance_vals.append(open_attendance)
+            return True
+        if open_attendance:
+            pending_closes[open_attendance.id] = atten_time
+            return True
+        return False
 
     ### Action restart device
     def action_restart_device(self):
-        """For restarting the device"""
-        zk = ZK(
-            self.device_ip,
-            port=self.port_number,
-            timeout=15,
-            password=0,
-            force_udp=False,
-            ommit_ping=False,
-        )
-        self.device_connect(zk).restart()
+        """For restarting the devices"""
+        _require_zk()
+        for info in self:
+            # The restart command is answered right away, do not wait long
+            # for a device that is not reachable
+            with info._zk_session(timeout=3) as conn:
+                conn.restart()
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+import logging
 from odoo import api, fields, models
+from odoo.tools.sql import create_unique_index, index_exists
+
+_logger = logging.getLogger(__name__)
 
 
 class ZkMachineAttendance(models.Model):
@@ -30,3 +34,23 @@ class ZkMachineAttendance(models.Model):
                                     help="Punching time in the device")
     address_id = fields.Many2one('res.partner', string='Working Address',
                                  help="Working address of the employee")
+
+    def init(self):
+        """Make the device id and punching time unique, used to find the
+        punches already downloaded and to skip them when inserting"""
+        super().init()
+        if not index_exists(self._cr, 'zk_machine_attendance_device_time_uniq'):
+            # Remove the punches stored twice, refused by the unique index
+            self._cr.execute("""
+                DELETE FROM zk_machine_attendance a
+                USING zk_machine_attendance b
+                WHERE a.device_id_num = b.device_id_num
+                    AND a.punching_time = b.punching_time
+                    AND a.id > b.id
+            """)
+            if self._cr.rowcount:
+                _logger.info('Removed %s duplicate punches from %s',
+                             self._cr.rowcount, self._table)
+            create_unique_index(
+                self._cr, 'zk_machine_attendance_device_time_uniq',
+                self._table, ['device_id_num', 'punching_time'])